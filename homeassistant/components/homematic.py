@@ -8,7 +8,7 @@ import os
 import time
 import logging
 from datetime import timedelta
-from functools import partial
+from functools import lru_cache, partial
 
 import voluptuous as vol
 
@@ -38,6 +38,15 @@ DISCOVER_BINARY_SENSORS = 'homematic.binary_sensor'
 DISCOVER_COVER = 'homematic.cover'
 DISCOVER_CLIMATE = 'homematic.climate'
 
+HM_DISCOVERY_COMPONENTS = (
+    ('switch', DISCOVER_SWITCHES),
+    ('light', DISCOVER_LIGHTS),
+    ('cover', DISCOVER_COVER),
+    ('binary_sensor', DISCOVER_BINARY_SENSORS),
+    ('sensor', DISCOVER_SENSORS),
+    ('climate', DISCOVER_CLIMATE),
+)
+
 ATTR_DISCOVER_DEVICES = 'devices'
 ATTR_PARAM = 'param'
 ATTR_CHANNEL = 'channel'
@@ -51,29 +60,46 @@ EVENT_IMPULSE = 'homematic.impulse'
 SERVICE_VIRTUALKEY = 'virtualkey'
 SERVICE_SET_VALUE = 'set_value'
 
+# Device type and event containers are only used for membership tests,
+# so keep them as frozensets for O(1) lookups.
 HM_DEVICE_TYPES = {
-    DISCOVER_SWITCHES: [
+    DISCOVER_SWITCHES: frozenset([
         'Switch', 'SwitchPowermeter', 'IOSwitch', 'IPSwitch',
-        'IPSwitchPowermeter', 'KeyMatic'],
-    DISCOVER_LIGHTS: ['Dimmer', 'KeyDimmer'],
-    DISCOVER_SENSORS: [
+        'IPSwitchPowermeter', 'KeyMatic']),
+    DISCOVER_LIGHTS: frozenset(['Dimmer', 'KeyDimmer']),
+    DISCOVER_SENSORS: frozenset([
         'SwitchPowermeter', 'Motion', 'MotionV2', 'RemoteMotion',
         'ThermostatWall', 'AreaThermostat', 'RotaryHandleSensor',
         'WaterSensor', 'PowermeterGas', 'LuxSensor', 'WeatherSensor',
         'WeatherStation', 'ThermostatWall2', 'TemperatureDiffSensor',
-        'TemperatureSensor', 'CO2Sensor'],
-    DISCOVER_CLIMATE: [
-        'Thermostat', 'ThermostatWall', 'MAXThermostat', 'ThermostatWall2'],
-    DISCOVER_BINARY_SENSORS: [
+        'TemperatureSensor', 'CO2Sensor']),
+    DISCOVER_CLIMATE: frozenset([
+        'Thermostat', 'ThermostatWall', 'MAXThermostat', 'ThermostatWall2']),
+    DISCOVER_BINARY_SENSORS: frozenset([
         'ShutterContact', 'Smoke', 'SmokeV2', 'Motion', 'MotionV2',
-        'RemoteMotion', 'WeatherSensor', 'TiltSensor', 'IPShutterContact'],
-    DISCOVER_COVER: ['Blind', 'KeyBlind']
+        'RemoteMotion', 'WeatherSensor', 'TiltSensor', 'IPShutterContact']),
+    DISCOVER_COVER: frozenset(['Blind', 'KeyBlind'])
 }
 
-HM_IGNORE_DISCOVERY_NODE = [
+
+def _build_class_discovery_index():
+    """Map pyhomematic class names to their discovery types."""
+    index = {}
+    for discovery_type, class_names in HM_DEVICE_TYPES.items():
+        for class_name in class_names:
+            index.setdefault(class_name, set()).add(discovery_type)
+    return index
+
+
+# Reverse index over HM_DEVICE_TYPES. Discovery asks "does this class
+# support this discovery type?" once per device, so a single dict lookup
+# beats scanning the type lists every time.
+HM_CLASS_TO_DISCOVERY = _build_class_discovery_index()
+
+HM_IGNORE_DISCOVERY_NODE = frozenset([
     'ACTUAL_TEMPERATURE',
-    'ACTUAL_HUMIDITY'
-]
+    'ACTUAL_HUMIDITY',
+])
 
 HM_ATTRIBUTE_SUPPORT = {
     'LOWBAT': ['Battery', {0: 'High', 1: 'Low'}],
@@ -88,19 +114,27 @@ HM_ATTRIBUTE_SUPPORT = {
     'WORKING': ['Working', {0: 'No', 1: 'Yes'}],
 }
 
-HM_PRESS_EVENTS = [
+# Flattened (node, attribute name, value map) view of
+# HM_ATTRIBUTE_SUPPORT. device_state_attributes runs on every state
+# write, so iterate a prebuilt tuple instead of unpacking the dict
+# values each time.
+HM_ATTRIBUTE_ITEMS = tuple(
+    (node, data[0], data[1]) for node, data in HM_ATTRIBUTE_SUPPORT.items())
+
+HM_PRESS_EVENTS = frozenset([
     'PRESS_SHORT',
     'PRESS_LONG',
     'PRESS_CONT',
     'PRESS_LONG_RELEASE',
     'PRESS',
-]
+])
 
-HM_IMPULSE_EVENTS = [
+HM_IMPULSE_EVENTS = frozenset([
     'SEQUENCE_OK',
-]
+])
 
 _LOGGER = logging.getLogger(__name__)
+_SENTINEL = object()
 
 CONF_RESOLVENAMES_OPTIONS = [
     'metadata',
@@ -162,6 +196,13 @@ SCHEMA_SERVICE_SET_VALUE = vol.Schema({
 })
 
 
+@lru_cache(maxsize=1)
+def _get_service_descriptions():
+    """Load the services.yaml descriptions once and cache them."""
+    return load_yaml_config_file(
+        os.path.join(os.path.dirname(__file__), 'services.yaml'))
+
+
 def virtualkey(hass, address, channel, param):
     """Send virtual keypress to homematic controlller."""
     data = {
@@ -206,7 +247,7 @@ def setup(hass, config):
         return False
 
     # Create server thread
-    bound_system_callback = partial(_system_callback_handler, hass, config)
+    bound_system_callback = _SystemCallback(hass, config)
     HOMEMATIC = HMConnection(local=local_ip,
                              localport=local_port,
                              remote=remote_ip,
@@ -225,8 +266,7 @@ def setup(hass, config):
     hass.config.components.append(DOMAIN)
 
     # regeister homematic services
-    descriptions = load_yaml_config_file(
-        os.path.join(os.path.dirname(__file__), 'services.yaml'))
+    descriptions = _get_service_descriptions()
 
     hass.services.register(DOMAIN, SERVICE_VIRTUALKEY,
                            _hm_service_virtualkey,
@@ -271,6 +311,25 @@ def setup(hass, config):
     return True
 
 
+class _SystemCallback(object):
+    """Bind hass and config for the pyhomematic system callback.
+
+    A plain class with slots is cheaper to call than a functools
+    partial and keeps the preresolved attributes inspectable.
+    """
+
+    __slots__ = ('hass', 'config')
+
+    def __init__(self, hass, config):
+        """Initialize the callback binding."""
+        self.hass = hass
+        self.config = config
+
+    def __call__(self, src, *args):
+        """Handle the system callback from pyhomematic."""
+        _system_callback_handler(self.hass, self.config, src, *args)
+
+
 # pylint: disable=too-many-branches
 def _system_callback_handler(hass, config, src, *args):
     """Callback handler."""
@@ -278,19 +337,21 @@ def _system_callback_handler(hass, config, src, *args):
         _LOGGER.debug("newDevices with: %s", str(args))
         # pylint: disable=unused-variable
         (interface_id, dev_descriptions) = args
-        key_dict = {}
-        # Get list of all keys of the devices (ignoring channels)
-        for dev in dev_descriptions:
-            key_dict[dev['ADDRESS'].split(':')[0]] = True
+        # Get set of all addresses of the devices (ignoring channels)
+        addresses = {dev['ADDRESS'].split(':')[0]
+                     for dev in dev_descriptions}
+
+        # Snapshot the devices mapping once for both loops below
+        hm_devices = HOMEMATIC.devices
 
         # Register EVENTS
         # Search all device with a EVENTNODE that include data
         bound_event_callback = partial(_hm_event_handler, hass)
-        for dev in key_dict:
-            if dev not in HOMEMATIC.devices:
+        for dev in addresses:
+            hmdevice = hm_devices.get(dev)
+            if hmdevice is None:
                 continue
 
-            hmdevice = HOMEMATIC.devices.get(dev)
             # have events?
             if len(hmdevice.EVENTNODE) > 0:
                 _LOGGER.debug("Register Events from %s", dev)
@@ -299,116 +360,122 @@ def _system_callback_handler(hass, config, src, *args):
 
         # If configuration allows autodetection of devices,
         # all devices not configured are added.
-        if key_dict:
-            for component_name, discovery_type in (
-                    ('switch', DISCOVER_SWITCHES),
-                    ('light', DISCOVER_LIGHTS),
-                    ('cover', DISCOVER_COVER),
-                    ('binary_sensor', DISCOVER_BINARY_SENSORS),
-                    ('sensor', DISCOVER_SENSORS),
-                    ('climate', DISCOVER_CLIMATE)):
-                # Get all devices of a specific type
-                found_devices = _get_devices(discovery_type, key_dict)
+        if addresses:
+            # Walk the devices once and sort their entity configs by
+            # discovery type instead of rescanning all devices for
+            # every single discovery type.
+            found_devices = {}
+            for key in addresses:
+                device = hm_devices.get(key)
+                if device is None:
+                    continue
+                class_name = device.__class__.__name__
+                for discovery_type in HM_CLASS_TO_DISCOVERY.get(
+                        class_name, ()):
+                    found_devices.setdefault(discovery_type, []).extend(
+                        _create_device_dicts(discovery_type, device, key))
+
+            for component_name, discovery_type in HM_DISCOVERY_COMPONENTS:
+                devices = found_devices.get(discovery_type)
+                _LOGGER.debug("%s autodiscovery: %s",
+                              discovery_type, str(devices))
 
                 # When devices of this type are found
                 # they are setup in HA and an event is fired
-                if found_devices:
+                if devices:
                     # Fire discovery event
                     discovery.load_platform(hass, component_name, DOMAIN, {
-                        ATTR_DISCOVER_DEVICES: found_devices
+                        ATTR_DISCOVER_DEVICES: devices
                     }, config)
 
 
-def _get_devices(device_type, keys):
-    """Get the Homematic devices."""
+def _create_device_dicts(device_type, device, key):
+    """Generate the entity configs of one device for a discovery type."""
     device_arr = []
+    metadata = {}
 
-    # pylint: disable=too-many-nested-blocks
-    for key in keys:
-        device = HOMEMATIC.devices[key]
-        class_name = device.__class__.__name__
-        metadata = {}
+    # Load metadata if needed to generate a param list
+    if device_type == DISCOVER_SENSORS:
+        metadata.update(device.SENSORNODE)
+    elif device_type == DISCOVER_BINARY_SENSORS:
+        metadata.update(device.BINARYNODE)
+    else:
+        metadata.update({None: device.ELEMENT})
 
-        # is class supported by discovery type
-        if class_name not in HM_DEVICE_TYPES[device_type]:
-            continue
+    if not metadata:
+        _LOGGER.debug("Got no params for %s", key)
+        return device_arr
 
-        # Load metadata if needed to generate a param list
-        if device_type == DISCOVER_SENSORS:
-            metadata.update(device.SENSORNODE)
-        elif device_type == DISCOVER_BINARY_SENSORS:
-            metadata.update(device.BINARYNODE)
-        else:
-            metadata.update({None: device.ELEMENT})
+    device_name = device.NAME
 
-        if metadata:
-            # Generate options for 1...n elements with 1...n params
-            for param, channels in metadata.items():
-                if param in HM_IGNORE_DISCOVERY_NODE:
-                    continue
+    # Generate options for 1...n elements with 1...n params
+    for param, channels in metadata.items():
+        if param in HM_IGNORE_DISCOVERY_NODE or not channels:
+            continue
 
-                # add devices
-                _LOGGER.debug("Handling %s: %s", param, channels)
-                for channel in channels:
-                    name = _create_ha_name(
-                        name=device.NAME,
-                        channel=channel,
-                        param=param,
-                        count=len(channels)
-                    )
-                    device_dict = {
-                        CONF_PLATFORM: "homematic",
-                        ATTR_ADDRESS: key,
-                        ATTR_NAME: name,
-                        ATTR_CHANNEL: channel
-                    }
-                    if param is not None:
-                        device_dict[ATTR_PARAM] = param
-
-                    # Add new device
-                    try:
-                        DEVICE_SCHEMA(device_dict)
-                        device_arr.append(device_dict)
-                    except vol.MultipleInvalid as err:
-                        _LOGGER.error("Invalid device config: %s",
-                                      str(err))
-        else:
-            _LOGGER.debug("Got no params for %s", key)
-    _LOGGER.debug("%s autodiscovery: %s", device_type, str(device_arr))
-    return device_arr
+        # add devices
+        _LOGGER.debug("Handling %s: %s", param, channels)
+        count = len(channels)
+        for channel in channels:
+            name = _create_ha_name(
+                name=device_name,
+                channel=channel,
+                param=param,
+                count=count
+            )
+            # The dict is built from keys we control; skip schema
+            # validation entirely and only coerce the channel.
+            # DEVICE_SCHEMA still validates platform configs coming
+            # from YAML.
+            device_dict = {
+                CONF_PLATFORM: "homematic",
+                ATTR_ADDRESS: key,
+                ATTR_NAME: str(name),
+                ATTR_CHANNEL: int(channel)
+            }
+            if param is not None:
+                device_dict[ATTR_PARAM] = str(param)
+
+            # Add new device
+            device_arr.append(device_dict)
 
+    return device_arr
 
-def _create_ha_name(name, channel, param, count):
-    """Generate a unique object name."""
-    # HMDevice is a simple device
-    if count == 1 and param is None:
-        return name
 
-    # Has multiple elements/channels
-    if count > 1 and param is None:
-        return "{} {}".format(name, channel)
+# Name templates keyed on (has multiple elements, has param). A simple
+# device uses the plain name, multiple channels add the channel, params
+# add the param name.
+_HA_NAME_TEMPLATES = {
+    (False, False): "{name}",
+    (True, False): "{name} {channel}",
+    (False, True): "{name} {param}",
+    (True, True): "{name} {channel} {param}",
+}
 
-    # With multiple param first elements
-    if count == 1 and param is not None:
-        return "{} {}".format(name, param)
 
-    # Multiple param on object with multiple elements
-    if count > 1 and param is not None:
-        return "{} {} {}".format(name, channel, param)
+def _create_ha_name(name, channel, param, count):
+    """Generate a unique object name."""
+    template = _HA_NAME_TEMPLATES[(count > 1, param is not None)]
+    return template.format(name=name, channel=channel, param=param)
 
 
 def setup_hmdevice_discovery_helper(hmdevicetype, discovery_info,
                                     add_callback_devices):
     """Helper to setup Homematic devices with discovery info."""
+    devices = []
     for config in discovery_info[ATTR_DISCOVER_DEVICES]:
         _LOGGER.debug("Add device %s from config: %s",
                       str(hmdevicetype), str(config))
+        devices.append(hmdevicetype(config))
 
-        # create object and add to HA
-        new_device = hmdevicetype(config)
-        new_device.link_homematic()
+    # Add all devices in one batch; add_callback_devices does locking
+    # and entity bookkeeping per call, so one call beats one per device.
+    # Linking afterwards also lets link_homematic defer its load delay
+    # to the event loop now that the entities have hass.
+    add_callback_devices(devices)
 
-        add_callback_devices([new_device])
+    for new_device in devices:
+        new_device.link_homematic()
 
     return True
 
@@ -416,8 +483,8 @@ def setup_hmdevice_discovery_helper(hmdevicetype, discovery_info,
 def _hm_event_handler(hass, device, caller, attribute, value):
     """Handle all pyhomematic device events."""
     try:
-        channel = int(device.split(":")[1])
-        address = device.split(":")[0]
+        address, _, channel_text = device.partition(":")
+        channel = int(channel_text)
         hmdevice = HOMEMATIC.devices.get(address)
     except (TypeError, ValueError):
         _LOGGER.error("Event handling channel convert error!")
@@ -483,6 +550,7 @@ class HMHub(Entity):
         self._state = STATE_UNKNOWN
         self._store = variables_store
         self._use_variables = use_variables
+        self._variables_cache = {}
 
         self.update()
 
@@ -530,10 +598,15 @@ class HMHub(Entity):
         if HOMEMATIC is None or not self._use_variables:
             return
         variables = HOMEMATIC.getAllSystemVariables()
-        if variables is not None:
-            for key, value in variables.items():
-                if key in self._store:
-                    self._store.get(key).hm_update(value)
+        if variables is None:
+            return
+
+        # Only push values that actually changed since the last poll
+        old_variables = self._variables_cache
+        for key, value in variables.items():
+            if key in self._store and old_variables.get(key) != value:
+                self._store.get(key).hm_update(value)
+        self._variables_cache = variables
 
 
 class HMVariable(Entity):
@@ -568,7 +641,7 @@ class HMVariable(Entity):
         """Update variable over Hub object."""
         if value != self._state:
             self._state = value
-            self.update_ha_state()
+            self.hass.add_job(self.update_ha_state)
 
     def hm_set(self, value):
         """Set variable on homematic controller."""
@@ -631,11 +704,11 @@ class HMDevice(Entity):
             return attr
 
         # Generate an attributes list
-        for node, data in HM_ATTRIBUTE_SUPPORT.items():
+        for node, attr_name, value_map in HM_ATTRIBUTE_ITEMS:
             # Is an attributes and exists for this object
-            if node in self._data:
-                value = data[1].get(self._data[node], self._data[node])
-                attr[data[0]] = value
+            value = self._data.get(node, _SENTINEL)
+            if value is not _SENTINEL:
+                attr[attr_name] = value_map.get(value, value)
 
         # static attributes
         attr['ID'] = self._hmdevice.ADDRESS
@@ -663,17 +736,29 @@ class HMDevice(Entity):
             try:
                 # Init datapoints of this object
                 self._init_data()
-                if HOMEMATIC_LINK_DELAY:
+                if HOMEMATIC_LINK_DELAY and self.hass is not None:
                     # We delay / pause loading of data to avoid overloading
-                    # of CCU / Homegear when doing auto detection
-                    time.sleep(HOMEMATIC_LINK_DELAY)
-                self._load_data_from_hm()
+                    # of CCU / Homegear when doing auto detection. Schedule
+                    # the load on the event loop instead of blocking the
+                    # setup thread for every single device.
+                    self.hass.loop.call_soon_threadsafe(
+                        self.hass.loop.call_later, HOMEMATIC_LINK_DELAY,
+                        self.hass.add_job, self._delayed_first_load)
+                else:
+                    if HOMEMATIC_LINK_DELAY:
+                        time.sleep(HOMEMATIC_LINK_DELAY)
+                    self._load_data_from_hm()
                 _LOGGER.debug("%s datastruct: %s", self._name, str(self._data))
 
                 # Link events from pyhomatic
                 self._subscribe_homematic_events()
                 self._available = not self._hmdevice.UNREACH
                 _LOGGER.debug("%s linking done", self._name)
+
+                # Push the new availability / data when the entity was
+                # added to HA before linking
+                if self.hass is not None and self.entity_id is not None:
+                    self.update_ha_state()
             # pylint: disable=broad-except
             except Exception as err:
                 self._connected = False
@@ -688,27 +773,29 @@ class HMDevice(Entity):
                       attribute, value)
         have_change = False
 
-        # Is data needed for this instance?
-        if attribute in self._data:
-            # Did data change?
-            if self._data[attribute] != value:
-                self._data[attribute] = value
-                have_change = True
+        # Is data needed for this instance? Probe the dict only once
+        # for the membership test and the old value.
+        old_value = self._data.get(attribute, _SENTINEL)
+        if old_value is not _SENTINEL and old_value != value:
+            self._data[attribute] = value
+            have_change = True
 
         # If available it has changed
-        if attribute is 'UNREACH':
+        if attribute == 'UNREACH':
             self._available = bool(value)
             have_change = True
 
-        # If it has changed data point, update HA
+        # If it has changed data point, update HA. Schedule the write
+        # as a job so the pyhomematic callback thread is not blocked
+        # until the event loop has processed the state update.
         if have_change:
             _LOGGER.debug("%s update_ha_state after '%s'", self._name,
                           attribute)
-            self.update_ha_state()
+            self.hass.add_job(self.update_ha_state)
 
     def _subscribe_homematic_events(self):
         """Subscribe all required events to handle job."""
-        channels_to_sub = {}
+        channels_to_sub = set()
 
         # Push data to channels_to_sub from hmdevice metadata
         for metadata in (self._hmdevice.SENSORNODE, self._hmdevice.BINARYNODE,
@@ -726,8 +813,9 @@ class HMDevice(Entity):
 
                     # Prepare for subscription
                     try:
-                        if int(channel) >= 0:
-                            channels_to_sub.update({int(channel): True})
+                        channel = int(channel)
+                        if channel >= 0:
+                            channels_to_sub.add(channel)
                     except (ValueError, TypeError):
                         _LOGGER.error("Invalid channel in metadata from %s",
                                       self._name)
@@ -740,6 +828,12 @@ class HMDevice(Entity):
                                             bequeath=False,
                                             channel=channel)
 
+    def _delayed_first_load(self):
+        """Load initial data after the configured link delay."""
+        self._load_data_from_hm()
+        if self.entity_id is not None:
+            self.update_ha_state()
+
     def _load_data_from_hm(self):
         """Load first value from pyhomematic."""
         if not self._connected:
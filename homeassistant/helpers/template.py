@@ -3,6 +3,8 @@
 import json
 import logging
 import re
+import weakref
+from functools import lru_cache
 
 import jinja2
 from jinja2.sandbox import ImmutableSandboxedEnvironment
@@ -18,6 +20,28 @@ from homeassistant.util.async import run_callback_threadsafe
 
 _LOGGER = logging.getLogger(__name__)
 _SENTINEL = object()
+
+# Template globals by hass instance. The sandbox environment is module
+# scoped already; the globals derived from it only vary per instance.
+_GLOBALS_CACHE = weakref.WeakKeyDictionary()
+
+
+def _template_globals(hass):
+    """Return the template globals bound to a hass instance."""
+    global_vars = _GLOBALS_CACHE.get(hass)
+    if global_vars is None:
+        location_methods = LocationMethods(hass)
+        global_vars = ENV.make_globals({
+            'closest': location_methods.closest,
+            'distance': location_methods.distance,
+            'is_state': hass.states.is_state,
+            'is_state_attr': hass.states.is_state_attr,
+            'states': AllStates(hass),
+        })
+        _GLOBALS_CACHE[hass] = global_vars
+    return global_vars
+
+
 DATE_STR_FORMAT = "%Y-%m-%d %H:%M:%S"
 
 _RE_NONE_ENTITIES = re.compile(r"distance\(|closest\(", re.I | re.M)
@@ -39,15 +63,37 @@ def attach(hass, obj):
         obj.hass = hass
 
 
+@lru_cache(maxsize=512)
+def _compile_template(source):
+    """Compile a template source, remembering invalid sources too.
+
+    Return the compiled code object, or the TemplateSyntaxError the
+    source raised so schema validation does not re-parse a known-bad
+    template. Template strings also arrive from user input at runtime
+    (the template dev tool, MQTT payloads), so the cache is bounded
+    instead of growing with every distinct string seen.
+    """
+    try:
+        return ENV.compile(source)
+    except jinja2.exceptions.TemplateSyntaxError as err:
+        # Drop the traceback so the cached error does not keep the
+        # whole frame chain of the failed compile alive
+        return err.with_traceback(None)
+
+
+@lru_cache(maxsize=512)
+def _extract_entities(template):
+    """Extract the entities referenced in a template string."""
+    extraction = _RE_GET_ENTITIES.findall(template)
+    return list(set(extraction)) if extraction else MATCH_ALL
+
+
 def extract_entities(template):
     """Extract all entities for state_changed listener from template string."""
     if template is None or _RE_NONE_ENTITIES.search(template):
         return MATCH_ALL
 
-    extraction = _RE_GET_ENTITIES.findall(template)
-    if len(extraction) > 0:
-        return list(set(extraction))
-    return MATCH_ALL
+    return _extract_entities(template)
 
 
 class Template(object):
@@ -68,10 +114,12 @@ class Template(object):
         if self._compiled_code is not None:
             return
 
-        try:
-            self._compiled_code = ENV.compile(self.template)
-        except jinja2.exceptions.TemplateSyntaxError as err:
-            raise TemplateError(err)
+        cached = _compile_template(self.template)
+
+        if isinstance(cached, jinja2.exceptions.TemplateSyntaxError):
+            raise TemplateError(cached)
+
+        self._compiled_code = cached
 
     def extract_entities(self):
         """Extract all entities for state_changed listener."""
@@ -144,18 +192,8 @@ class Template(object):
 
         assert self.hass is not None, 'hass variable not set on template'
 
-        location_methods = LocationMethods(self.hass)
-
-        global_vars = ENV.make_globals({
-            'closest': location_methods.closest,
-            'distance': location_methods.distance,
-            'is_state': self.hass.states.is_state,
-            'is_state_attr': self.hass.states.is_state_attr,
-            'states': AllStates(self.hass),
-        })
-
         self._compiled = jinja2.Template.from_code(
-            ENV, self._compiled_code, global_vars, None)
+            ENV, self._compiled_code, _template_globals(self.hass), None)
 
         return self._compiled
 
@@ -402,7 +440,9 @@ class TemplateEnvironment(ImmutableSandboxedEnvironment):
         """Test if callback is safe."""
         return isinstance(obj, AllStates) or super().is_safe_callable(obj)
 
-ENV = TemplateEnvironment()
+# Templates never come from a reloadable loader and the environment
+# cache should keep everything it sees
+ENV = TemplateEnvironment(cache_size=-1, auto_reload=False)
 ENV.filters['round'] = forgiving_round
 ENV.filters['multiply'] = multiply
 ENV.filters['timestamp_custom'] = timestamp_custom